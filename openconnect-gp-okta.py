@@ -2,36 +2,44 @@
 
 import base64
 import click
+import concurrent.futures
 import configparser
-import contextlib
+import functools
+import http.cookiejar
+import importlib.util
+import io
 import json
 import lxml.etree
 import os
 import re
 import requests
 import shlex
+import shutil
 import signal
 import ssl
 import subprocess
 import sys
+import time
 import urllib
 
-try:
-    import pyotp
-except ImportError:
-    pyotp = None
+from urllib3.util.retry import Retry
 
-HAS_FIDO2 = True
 try:
-    from fido2.client import Fido2Client, UserInteraction
-    from fido2.hid import list_devices
-    from fido2.utils import websafe_decode, websafe_encode
+    from orjson import dumps as json_dumps, loads as json_loads
 except ImportError:
-    HAS_FIDO2 = False
-    UserInteraction = object
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
+    json_loads = json.loads
 
+# pyotp and fido2 (which pulls in cryptography) are only imported once the
+# factor that needs them is actually used.
+HAS_PYOTP = importlib.util.find_spec('pyotp') is not None
+HAS_FIDO2 = importlib.util.find_spec('fido2') is not None
 
-class ConsoleInteraction(UserInteraction):
+
+# Implements fido2.client.UserInteraction; not subclassed so that fido2 need
+# not be imported up front.
+class ConsoleInteraction:
     def prompt_up(self):
         """Called when the authenticator is awaiting a user presence check."""
         click.echo("Touch your hardware token to confirm user presence")
@@ -54,22 +62,56 @@ class OktaWebauthn:
     # querying a generic URL.
     WEBAUTHN_URL_TEMPLATE = 'https://{}/api/v1/authn/factors/webauthn/verify'
 
-    def __init__(self):
+    def __init__(self, device_probe=None):
         assert HAS_FIDO2
         self._device = None
+        self._device_probe = device_probe
+
+    @staticmethod
+    def probe_device():
+        # Also import what okta_verify needs, so that a fido2 which is
+        # installed but fails to import shows up here as "no device".
+        for module in ('fido2.client', 'fido2.utils'):
+            importlib.import_module(module)
+        from fido2.hid import list_devices
+        return next(list_devices(), None)
+
+    @staticmethod
+    def close_probed_device(device_probe):
+        try:
+            device = device_probe.result()
+        except Exception:
+            return
+        if device is not None:
+            device.close()
 
     def get_device(self):
-        self._device = next(list_devices(), None)
+        try:
+            if self._device_probe is not None:
+                device_probe, self._device_probe = self._device_probe, None
+                self._device = device_probe.result()
+            else:
+                self._device = self.probe_device()
+        except Exception as e:
+            click.echo(f"Could not look for webauthn devices ({e}), falling back to other MFA method.")
+            return False
         while self._device is None:
             click.echo("Please insert a suitable device if you wish to continue with webauthn MFA.")
             if click.confirm("Continue with webauthn MFA?"):
-                self._device = next(list_devices(), None)
+                try:
+                    self._device = self.probe_device()
+                except Exception as e:
+                    click.echo(f"Could not look for webauthn devices ({e}), falling back to other MFA method.")
+                    break
             else:
                 click.echo("Falling back to other MFA method.")
                 break
         return self._device is not None
 
     def okta_verify(self, session, domain, stateToken):
+        from fido2.client import Fido2Client
+        from fido2.utils import websafe_decode
+
         url = self.WEBAUTHN_URL_TEMPLATE.format(domain)
         r = post_json(session, url, {'stateToken': stateToken})
         assert r['status'] == 'MFA_CHALLENGE'
@@ -93,11 +135,10 @@ class OktaWebauthn:
         assertion = fido_client.get_assertion(pubkey_req).get_response(0)
 
         def b64(obj):
-            # websafe_encode(obj) takes a python object and serializes it using
-            # methods defined by this given object so that (obj !=
-            # websafe_decode(websafe_encode(obj))). The latter is a bytestring
-            # that then needs to be correctly base64 encoded for Okta.
-            return base64.b64encode(websafe_decode(websafe_encode(obj))).decode('ascii')
+            # AuthenticatorData and CollectedClientData are bytes subclasses
+            # holding their serialized form, so bytes(obj) yields exactly what
+            # Okta expects base64 encoded, without a websafe round-trip.
+            return base64.b64encode(bytes(obj)).decode('ascii')
 
         next_url = r['_links']['next']['href']
         payload = {
@@ -113,127 +154,251 @@ def check(r):
     r.raise_for_status()
     return r
 
-def extract_form(html):
-    form = lxml.etree.fromstring(html, lxml.etree.HTMLParser()).find('.//form')
+_HTML_PARSER = lxml.etree.HTMLParser(recover=True, no_network=True, huge_tree=False)
+_XML_PARSER = lxml.etree.XMLParser(resolve_entities=False, no_network=True)
+
+# Forms above this size (in practice, a SAMLResponse) are parsed incrementally
+STREAM_FORM_THRESHOLD = 64 * 1024
+
+def form_fields(form):
     return (form.attrib['action'],
         {inp.attrib['name']: inp.attrib['value'] for inp in form.findall('input')})
 
+def extract_form(html):
+    if len(html) > STREAM_FORM_THRESHOLD:
+        return extract_form_stream(html)
+    form = lxml.etree.fromstring(html, _HTML_PARSER).find('.//form')
+    return form_fields(form)
+
+def extract_form_stream(html):
+    if isinstance(html, str):
+        html = html.encode()
+    for _, form in lxml.etree.iterparse(io.BytesIO(html), tag='form', html=True,
+            recover=True, no_network=True):
+        fields = form_fields(form)
+        form.clear()
+        return fields
+    raise Exception('No form found')
+
 def prelogin(s, gateway):
-    r = check(s.post('https://{}/ssl-vpn/prelogin.esp'.format(gateway)))
-    saml_req_html = base64.b64decode(lxml.etree.fromstring(r.content).find('saml-request').text)
+    with s.post('https://{}/ssl-vpn/prelogin.esp'.format(gateway), stream=True) as r:
+        check(r)
+        r.raw.decode_content = True
+        tree = lxml.etree.parse(r.raw, _XML_PARSER)
+    saml_req_html = base64.b64decode(tree.find('saml-request').text)
     saml_req_url, saml_req_data = extract_form(saml_req_html)
     assert 'SAMLRequest' in saml_req_data
-    return saml_req_url + '?' + urllib.parse.urlencode(saml_req_data)
+    return saml_req_url, saml_req_data
 
 def post_json(s, url, data):
-    r = check(s.post(url, data=json.dumps(data),
+    r = check(s.post(url, data=json_dumps(data),
         headers={'Content-Type': 'application/json'}))
-    return r.json()
+    return json_loads(r.content)
+
+_TOKEN_RE = re.compile(r'token(?::|$)')
+
+PUSH_MAX_RATE_LIMITED = 5
+
+def verify_push(s, url, state_token):
+    correct_answer = None
+    wait = 2.0
+    rate_limited = 0
+    while True:
+        try:
+            r = post_json(s, url, {'stateToken': state_token})
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code != 429:
+                raise
+            rate_limited += 1
+            if rate_limited >= PUSH_MAX_RATE_LIMITED:
+                raise
+            # Rate limited: back off, honouring Retry-After if given
+            wait = min(wait * 2, 5.0)
+            try:
+                time.sleep(float(e.response.headers['Retry-After']))
+            except (KeyError, ValueError):
+                time.sleep(wait)
+            continue
+        wait = 2.0
+        rate_limited = 0
+        if r['status'] != 'MFA_CHALLENGE':
+            return r
+        state_token = r['stateToken']
+        assert r['factorResult'] == 'WAITING'
+        if correct_answer is None:
+            try:
+                correct_answer = r["_embedded"]["factor"]["_embedded"]["challenge"]["correctAnswer"]
+                click.echo(f"Correct 3-number answer is: {correct_answer}")
+            except KeyError:
+                pass
+        time.sleep(wait)
+
+def verify_sms(s, url, state_token):
+    r = post_json(s, url, {'stateToken': state_token})
+    assert r['status'] == 'MFA_CHALLENGE'
+    code = click.prompt('SMS code')
+    return post_json(s, url, {'stateToken': r['stateToken'], 'passCode': code})
+
+FACTOR_VERIFIERS = {
+    'push': verify_push,
+    'sms': verify_sms,
+}
 
 def okta_auth(s, domain, username, password, factor_priorities, totp_key):
     r = post_json(s, 'https://{}/api/v1/authn'.format(domain),
         {'username': username, 'password': password})
 
     if r['status'] == 'MFA_REQUIRED':
-        def priority(factor):
-            return factor_priorities.get(factor['factorType'], 0)
+        get_priority = factor_priorities.get
+        factors = sorted(r['_embedded']['factors'],
+            key=lambda f: get_priority(f['factorType'], 0), reverse=True)
 
         ignore_webauthn = not HAS_FIDO2
-        for factor in sorted(r['_embedded']['factors'], key=priority, reverse=True):
-            if factor['factorType'] == 'push':
-                url = factor['_links']['verify']['href']
-                correct_answer = None
-                while True:
-                    r = post_json(s, url, {'stateToken': r['stateToken']})
-                    if r['status'] != 'MFA_CHALLENGE':
-                        break
-                    assert r['factorResult'] == 'WAITING'
-                    if correct_answer is None:
+        device_probe = None
+        if not ignore_webauthn and any(f['factorType'] == 'webauthn' for f in factors):
+            # Enumerating HID devices is slow, so do it in the background while
+            # any higher priority factors are being tried.
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            device_probe = executor.submit(OktaWebauthn.probe_device)
+            executor.shutdown(wait=False)
+
+        try:
+            for factor in factors:
+                ftype = factor['factorType']
+                url = factor.get('_links', {}).get('verify', {}).get('href')
+                if ftype in FACTOR_VERIFIERS:
+                    r = FACTOR_VERIFIERS[ftype](s, url, r['stateToken'])
+                    break
+                if ftype == 'webauthn' and not ignore_webauthn:
+                    webauthn = OktaWebauthn(device_probe)
+                    device_probe = None
+                    if webauthn.get_device():
                         try:
-                            correct_answer = r["_embedded"]["factor"]["_embedded"]["challenge"]["correctAnswer"]
-                            click.echo(f"Correct 3-number answer is: {correct_answer}")
-                        except KeyError:
-                            pass
-                break
-            if factor['factorType'] == 'sms':
-                url = factor['_links']['verify']['href']
-                r = post_json(s, url, {'stateToken': r['stateToken']})
-                assert r['status'] == 'MFA_CHALLENGE'
-                code = click.prompt('SMS code')
-                r = post_json(s, url, {'stateToken': r['stateToken'], 'passCode': code})
-                break
-            if factor['factorType'] == 'webauthn' and not ignore_webauthn:
-                webauthn = OktaWebauthn()
-                if webauthn.get_device():
-                    r = webauthn.okta_verify(s, domain, r['stateToken'])
-                else:
-                    ignore_webauthn = True
-                    continue
-                break
-            if re.match('token(?::|$)', factor['factorType']):
-                url = factor['_links']['verify']['href']
-                if (factor['factorType'] == 'token:software:totp') and (totp_key is not None):
-                    code = pyotp.TOTP(totp_key).now()
-                else:
-                    code = click.prompt('One-time code for {} ({})'.format(factor['provider'], factor['vendorName']))
-                r = post_json(s, url, {'stateToken': r['stateToken'], 'passCode': code})
-                break
-        else:
-            raise Exception('No supported authentication factors')
+                            r = webauthn.okta_verify(s, domain, r['stateToken'])
+                        except ImportError as e:
+                            click.echo(f"webauthn unavailable ({e}), falling back to other MFA method.")
+                            ignore_webauthn = True
+                            continue
+                    else:
+                        ignore_webauthn = True
+                        continue
+                    break
+                if _TOKEN_RE.match(ftype):
+                    if (ftype == 'token:software:totp') and (totp_key is not None):
+                        import pyotp
+                        code = pyotp.TOTP(totp_key).now()
+                    else:
+                        code = click.prompt('One-time code for {} ({})'.format(factor['provider'], factor['vendorName']))
+                    r = post_json(s, url, {'stateToken': r['stateToken'], 'passCode': code})
+                    break
+            else:
+                raise Exception('No supported authentication factors')
+        finally:
+            # A device probed for but never used must not stay open
+            if device_probe is not None:
+                device_probe.add_done_callback(OktaWebauthn.close_probed_device)
 
     if r['status'] == 'LOCKED_OUT':
         raise Exception('Locked out of Okta!')
     assert r['status'] == 'SUCCESS'
     return r['sessionToken']
 
-def okta_saml(s, saml_req_url, username, password, factor_priorities, totp_key):
+def okta_saml(s, saml_req_url, saml_req_data, username, password, factor_priorities, totp_key):
     domain = urllib.parse.urlparse(saml_req_url).netloc
 
-    # Just to set DT cookie
-    check(s.get(saml_req_url))
+    # Just to set DT cookie, unless a previous run already left us one
+    if not any(c.name == 'DT' and c.domain.endswith(domain) for c in s.cookies):
+        check(s.get(saml_req_url, params=saml_req_data))
 
     token = okta_auth(s, domain, username, password, factor_priorities, totp_key)
 
+    redirect_url = saml_req_url + '?' + urllib.parse.urlencode(saml_req_data)
     r = check(s.get('https://{}/login/sessionCookieRedirect'.format(domain),
-        params={'token': token, 'redirectUrl': saml_req_url}))
+        params={'token': token, 'redirectUrl': redirect_url}))
     saml_resp_url, saml_resp_data = extract_form(r.content)
     assert 'SAMLResponse' in saml_resp_data
     return saml_resp_url, saml_resp_data
 
+def load_cookies(s, path):
+    jar = http.cookiejar.LWPCookieJar(path)
+    try:
+        jar.load()
+    except (OSError, http.cookiejar.LoadError):
+        return
+    for c in jar:
+        s.cookies.set_cookie(c)
+
+def save_cookies(s, path):
+    # Only the DT (device token) cookie is worth keeping between runs; the
+    # Okta session cookies must not outlive this login.
+    jar = http.cookiejar.LWPCookieJar(path)
+    for c in s.cookies:
+        if c.name == 'DT':
+            jar.set_cookie(c)
+    old_umask = os.umask(0o077)
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        jar.save()
+    except OSError:
+        pass
+    finally:
+        os.umask(old_umask)
+
 def complete_saml(s, saml_resp_url, saml_resp_data):
     r = check(s.post(saml_resp_url, data=saml_resp_data))
     return r.headers['saml-username'], r.headers['prelogin-cookie']
 
-@contextlib.contextmanager
-def signal_mask(how, mask):
-    old_mask = signal.pthread_sigmask(how, mask)
-    try:
-        yield old_mask
-    finally:
-        signal.pthread_sigmask(signal.SIG_SETMASK, old_mask)
-
-@contextlib.contextmanager
-def signal_handler(num, handler):
-    old_handler = signal.signal(num, handler)
-    try:
-        yield old_handler
-    finally:
-        signal.signal(num, old_handler)
-
-@contextlib.contextmanager
-def popen_forward_sigterm(args, *, stdin=None):
-    with signal_mask(signal.SIG_BLOCK, {signal.SIGTERM}) as old_mask:
-        with subprocess.Popen(args, stdin=stdin,
-                preexec_fn=lambda: signal.pthread_sigmask(signal.SIG_SETMASK, old_mask)) as p:
-            with signal_handler(signal.SIGTERM, lambda *args: p.terminate()):
-                with signal_mask(signal.SIG_SETMASK, old_mask):
-                    yield p
-                    if p.stdin:
-                        p.stdin.close()
-                    os.waitid(os.P_PID, p.pid, os.WEXITED | os.WNOWAIT)
+def resolve_argv(argv):
+    # subprocess only uses the posix_spawn fast path for an absolute
+    # executable with no preexec_fn (and, before Python 3.13, close_fds=False).
+    exe = shutil.which(argv[0]) if argv else None
+    return [exe] + argv[1:] if exe else argv
+
+class PopenForwardSigterm:
+    """Popen-like context manager that forwards SIGTERM to the child.
+
+    The handler is installed before spawning, so a SIGTERM arriving while
+    the child starts is remembered and forwarded once it exists. This keeps
+    the child's signal mask untouched, without needing a preexec_fn.
+    """
+
+    def __init__(self, args, *, stdin=None):
+        self._args = resolve_argv(list(args))
+        self._stdin = stdin
+        self._p = None
+        self._pending = False
+        self._old_handler = None
+
+    def _forward(self, *args):
+        if self._p is None:
+            self._pending = True
+        else:
+            self._p.terminate()
+
+    def __enter__(self):
+        self._old_handler = signal.signal(signal.SIGTERM, self._forward)
+        try:
+            self._p = subprocess.Popen(self._args, stdin=self._stdin)
+        except BaseException:
+            signal.signal(signal.SIGTERM, self._old_handler)
+            raise
+        if self._pending:
+            self._p.terminate()
+        return self._p
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        p = self._p
+        try:
+            if exc_type is None:
+                if p.stdin:
+                    p.stdin.close()
+                os.waitid(os.P_PID, p.pid, os.WEXITED | os.WNOWAIT)
+            p.__exit__(exc_type, exc_value, traceback)
+        finally:
+            signal.signal(signal.SIGTERM, self._old_handler)
 
 def run_cmd(cmd, confvar):
-    out = subprocess.run(shlex.split(cmd), capture_output=True, text=True)
+    out = subprocess.run(resolve_argv(shlex.split(cmd)), capture_output=True, text=True)
     output = out.stdout.splitlines()
     if out.returncode != 0 or len(output) == 0:
         click.echo(f"{confvar} command failed with return status {out.returncode}:", err=True)
@@ -247,12 +412,38 @@ def run_cmd(cmd, confvar):
         return out.stdout.splitlines()[0]
     return None
 
+@functools.lru_cache(maxsize=None)
+def ssl_context():
+    # Loading the system CA bundle is expensive; build the context only once
+    ctx = ssl.create_default_context()
+    ctx.options |= 0x4
+    ctx.set_alpn_protocols(['http/1.1'])
+    return ctx
+
+class OktaRetry(Retry):
+    # A POST answered with a 5xx may still have been acted on (sending a push
+    # or an SMS), so only rate limiting is retried for anything but GET.
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method.upper() != 'GET' and status_code != 429:
+            return False
+        return super(OktaRetry, self).is_retry(method, status_code, has_retry_after)
+
 class TLSAdapter(requests.adapters.HTTPAdapter):
 
+        # Ride out transient Okta rate limiting and gateway errors on the
+        # pooled connection. Read errors are not retried, as the request may
+        # already have been processed. The last response is handed back
+        # rather than raised, so check() still reports it as an HTTPError.
+        RETRY = OktaRetry(total=4, read=0, backoff_factor=1.0,
+            status_forcelist=(429, 502, 503, 504),
+            allowed_methods=frozenset(['GET', 'POST']),
+            respect_retry_after_header=True, raise_on_status=False)
+
+        def __init__(self, *args, max_retries=RETRY, **kwargs):
+            super(TLSAdapter, self).__init__(*args, max_retries=max_retries, **kwargs)
+
         def init_poolmanager(self, *args, **kwargs):
-            ctx = ssl.create_default_context()
-            ctx.options |= 0x4
-            kwargs['ssl_context'] = ctx
+            kwargs['ssl_context'] = ssl_context()
             return super(TLSAdapter, self).init_poolmanager(*args, **kwargs)
 
 @click.command()
@@ -266,6 +457,7 @@ class TLSAdapter(requests.adapters.HTTPAdapter):
 @click.option('--totp-key')
 @click.option('--totp-key-cmd')
 @click.option('--sudo/--no-sudo', default=None)
+@click.option('--cookie-jar')
 def main(
     gateway,
     openconnect_args,
@@ -277,21 +469,42 @@ def main(
     totp_key,
     totp_key_cmd,
     sudo,
+    cookie_jar,
 ):
-    args = { k: v for k, v in locals().items() if v is not None }
+    args = {k: v for k, v in (
+        ('gateway', gateway),
+        ('username', username),
+        ('password', password),
+        ('password_cmd', password_cmd),
+        ('totp_key', totp_key),
+        ('totp_key_cmd', totp_key_cmd),
+        ('sudo', sudo),
+        ('cookie_jar', cookie_jar),
+    ) if v is not None}
 
     conf = configparser.ConfigParser()
     conf.optionxform = lambda opt: opt.replace('_', '-')
-    conf.read(config)
-
-    gateway = conf.get('common', 'gateway', vars=args, fallback=gateway)
-    openconnect_args += tuple(shlex.split(conf.get('common', 'openconnect-args', fallback="")))
-    username = conf.get('common', 'username', vars=args, fallback=username)
-    password = conf.get('common', 'password', vars=args, fallback=password)
-    password_cmd = conf.get('common', 'password-cmd', vars=args, fallback=password_cmd)
-    totp_key = conf.get('common', 'totp-key', vars=args, fallback=totp_key)
-    totp_key_cmd = conf.get('common', 'totp-key-cmd', vars=args, fallback=totp_key)
-    sudo = conf.get('common', 'sudo', vars=args, fallback=False if sudo is None else sudo)
+    if config:
+        conf.read(config)
+
+    # Passing the command line arguments as vars lets them override the file
+    # and be referenced from it, e.g. password-cmd = keyring get %(username)s
+    conf_vars = {k: v for k, v in args.items() if isinstance(v, str)}
+    common = dict(conf.items('common', vars=conf_vars)) if conf.has_section('common') else {}
+
+    def opt(name, fallback=None):
+        # Non-string arguments (--sudo) can't go through interpolation
+        return args.get(name.replace('-', '_'), common.get(name, fallback))
+
+    gateway = opt('gateway')
+    openconnect_args += tuple(shlex.split(common.get('openconnect-args', "")))
+    username = opt('username')
+    password = opt('password')
+    password_cmd = opt('password-cmd')
+    totp_key = opt('totp-key')
+    totp_key_cmd = opt('totp-key-cmd')
+    sudo = opt('sudo', False)
+    cookie_jar = opt('cookie-jar')
 
     if conf.has_section('factor-priority'):
         factor_priorities += tuple(
@@ -303,7 +516,7 @@ def main(
 
     if (totp_key_cmd is not None):
         totp_key = run_cmd(totp_key_cmd, "TOTP")
-    if (totp_key is not None) and (pyotp is None):
+    if (totp_key is not None) and not HAS_PYOTP:
         click.echo('--totp-key requires pyotp!', err=True)
         sys.exit(1)
 
@@ -324,9 +537,16 @@ def main(
         **dict(factor_priorities)}
 
     with requests.Session() as s:
-        s.mount('https://', TLSAdapter())
-        saml_req_url = prelogin(s, gateway)
-        saml_resp_url, saml_resp_data = okta_saml(s, saml_req_url, username, password, factor_priorities, totp_key)
+        # One pooled adapter for every host, so the whole Okta conversation
+        # reuses the same kept-alive TLS connections.
+        s.mount('https://', TLSAdapter(pool_connections=4, pool_maxsize=16))
+        if cookie_jar is not None:
+            cookie_jar = os.path.expanduser(cookie_jar)
+            load_cookies(s, cookie_jar)
+        saml_req_url, saml_req_data = prelogin(s, gateway)
+        saml_resp_url, saml_resp_data = okta_saml(s, saml_req_url, saml_req_data, username, password, factor_priorities, totp_key)
+        if cookie_jar is not None:
+            save_cookies(s, cookie_jar)
         saml_username, prelogin_cookie = complete_saml(s, saml_resp_url, saml_resp_data)
 
     subprocess_args = [
@@ -341,7 +561,7 @@ def main(
     if sudo:
         subprocess_args = ['sudo'] + subprocess_args
 
-    with popen_forward_sigterm(subprocess_args, stdin=subprocess.PIPE) as p:
+    with PopenForwardSigterm(subprocess_args, stdin=subprocess.PIPE) as p:
         p.stdin.write(prelogin_cookie.encode())
     sys.exit(p.returncode)
 